@@ -95,9 +95,9 @@ def remove_small_boxes(boxes, min_size):
         keep (Tensor[K]): indices of the boxes that have both sides
             larger than min_size
     """
-    ws, hs = boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]  # 预测boxes的宽和高
-    # keep = (ws >= min_size) & (hs >= min_size)  # 当满足宽，高都大于给定阈值时为True
-    keep = torch.logical_and(torch.ge(ws, min_size), torch.ge(hs, min_size))
+    wh = boxes[:, 2:] - boxes[:, :2]  # 预测boxes的宽和高 [N, 2]
+    # 当满足宽，高都大于给定阈值时为True
+    keep = torch.ge(wh, min_size).all(dim=1)
     # nonzero(): Returns a tensor containing the indices of all non-zero elements of input
     # keep = keep.nonzero().squeeze(1)
     keep = torch.where(keep)[0]
@@ -148,7 +148,7 @@ def box_area(boxes):
     Returns:
         area (Tensor[N]): area for each box
     """
-    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return (boxes[:, 2:] - boxes[:, :2]).prod(dim=1)
 
 
 def box_iou(boxes1, boxes2):
@@ -38,6 +38,39 @@ class BalancedPositiveNegativeSampler(object):
         """
         pos_idx = []
         neg_idx = []
+        sampled_pos_idx, sampled_neg_idx = self.sample_indices(matched_idxs)
+        for matched_idxs_per_image, pos_idx_per_image, neg_idx_per_image in zip(
+                matched_idxs, sampled_pos_idx, sampled_neg_idx):
+            # create binary mask from indices
+            pos_idx_per_image_mask = torch.zeros_like(
+                matched_idxs_per_image, dtype=torch.uint8
+            )
+            neg_idx_per_image_mask = torch.zeros_like(
+                matched_idxs_per_image, dtype=torch.uint8
+            )
+
+            pos_idx_per_image_mask[pos_idx_per_image] = 1
+            neg_idx_per_image_mask[neg_idx_per_image] = 1
+
+            pos_idx.append(pos_idx_per_image_mask)
+            neg_idx.append(neg_idx_per_image_mask)
+
+        return pos_idx, neg_idx
+
+    def sample_indices(self, matched_idxs):
+        # type: (List[Tensor]) -> Tuple[List[Tensor], List[Tensor]]
+        """
+        与__call__的采样方式相同，但直接返回采样得到的索引，不再生成binary mask
+        Arguments:
+            matched idxs: list of tensors containing -1, 0 or positive values.
+                Each tensor corresponds to a specific image.
+
+        Returns:
+            pos_idx (list[tensor]): indices of the selected positive elements for each image
+            neg_idx (list[tensor]): indices of the selected negative elements for each image
+        """
+        pos_idx = []
+        neg_idx = []
         # 遍历每张图像的matched_idxs(labels)
         for matched_idxs_per_image in matched_idxs:
             # >= 1的为正样本, nonzero返回非零元素索引
@@ -67,19 +100,8 @@ class BalancedPositiveNegativeSampler(object):
             pos_idx_per_image = positive[perm1]
             neg_idx_per_image = negative[perm2]
 
-            # create binary mask from indices
-            pos_idx_per_image_mask = torch.zeros_like(
-                matched_idxs_per_image, dtype=torch.uint8
-            )
-            neg_idx_per_image_mask = torch.zeros_like(
-                matched_idxs_per_image, dtype=torch.uint8
-            )
-
-            pos_idx_per_image_mask[pos_idx_per_image] = 1
-            neg_idx_per_image_mask[neg_idx_per_image] = 1
-
-            pos_idx.append(pos_idx_per_image_mask)
-            neg_idx.append(neg_idx_per_image_mask)
+            pos_idx.append(pos_idx_per_image)
+            neg_idx.append(neg_idx_per_image)
 
         return pos_idx, neg_idx
 
@@ -229,33 +251,36 @@ class BoxCoder(object):
         From a set of original boxes and encoded relative box offsets,
         get the decoded boxes.
 
+        支持带batch维度的输入，除最后一维外按广播机制计算，
+        如rel_codes: [batch_size, A, 4], boxes: [batch_size, A, 4]时输出为[batch_size, A, 4]
+
         Arguments:
-            rel_codes (Tensor): encoded boxes (bbox regression parameters)
-            boxes (Tensor): reference boxes (anchors/proposals)
+            rel_codes (Tensor): encoded boxes (bbox regression parameters) [..., 4*k]
+            boxes (Tensor): reference boxes (anchors/proposals) [..., 4]
         """
         boxes = boxes.to(rel_codes.dtype)
 
         # xmin, ymin, xmax, ymax
-        widths = boxes[:, 2] - boxes[:, 0]   # anchor/proposal宽度
-        heights = boxes[:, 3] - boxes[:, 1]  # anchor/proposal高度
-        ctr_x = boxes[:, 0] + 0.5 * widths   # anchor/proposal中心x坐标
-        ctr_y = boxes[:, 1] + 0.5 * heights  # anchor/proposal中心y坐标
+        widths = boxes[..., 2] - boxes[..., 0]   # anchor/proposal宽度
+        heights = boxes[..., 3] - boxes[..., 1]  # anchor/proposal高度
+        ctr_x = boxes[..., 0] + 0.5 * widths   # anchor/proposal中心x坐标
+        ctr_y = boxes[..., 1] + 0.5 * heights  # anchor/proposal中心y坐标
 
         wx, wy, ww, wh = self.weights  # RPN中为[1,1,1,1], fastrcnn中为[10,10,5,5]
-        dx = rel_codes[:, 0::4] / wx   # 预测anchors/proposals的中心坐标x回归参数
-        dy = rel_codes[:, 1::4] / wy   # 预测anchors/proposals的中心坐标y回归参数
-        dw = rel_codes[:, 2::4] / ww   # 预测anchors/proposals的宽度回归参数
-        dh = rel_codes[:, 3::4] / wh   # 预测anchors/proposals的高度回归参数
+        dx = rel_codes[..., 0::4] / wx   # 预测anchors/proposals的中心坐标x回归参数
+        dy = rel_codes[..., 1::4] / wy   # 预测anchors/proposals的中心坐标y回归参数
+        dw = rel_codes[..., 2::4] / ww   # 预测anchors/proposals的宽度回归参数
+        dh = rel_codes[..., 3::4] / wh   # 预测anchors/proposals的高度回归参数
 
         # limit max value, prevent sending too large values into torch.exp()
         # self.bbox_xform_clip=math.log(1000. / 16)   4.135
         dw = torch.clamp(dw, max=self.bbox_xform_clip)
         dh = torch.clamp(dh, max=self.bbox_xform_clip)
 
-        pred_ctr_x = dx * widths[:, None] + ctr_x[:, None]
-        pred_ctr_y = dy * heights[:, None] + ctr_y[:, None]
-        pred_w = torch.exp(dw) * widths[:, None]
-        pred_h = torch.exp(dh) * heights[:, None]
+        pred_ctr_x = dx * widths[..., None] + ctr_x[..., None]
+        pred_ctr_y = dy * heights[..., None] + ctr_y[..., None]
+        pred_w = torch.exp(dw) * widths[..., None]
+        pred_h = torch.exp(dh) * heights[..., None]
 
         # xmin
         pred_boxes1 = pred_ctr_x - torch.tensor(0.5, dtype=pred_ctr_x.dtype, device=pred_w.device) * pred_w
@@ -267,7 +292,7 @@ class BoxCoder(object):
         pred_boxes4 = pred_ctr_y + torch.tensor(0.5, dtype=pred_ctr_y.dtype, device=pred_h.device) * pred_h
 
         # [[-1,1],...] -> [-1,1,4] -> [-1,4]
-        pred_boxes = torch.stack((pred_boxes1, pred_boxes2, pred_boxes3, pred_boxes4), dim=2).flatten(1)
+        pred_boxes = torch.stack((pred_boxes1, pred_boxes2, pred_boxes3, pred_boxes4), dim=-1).flatten(-2)
         return pred_boxes
 
 
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+import math
 from typing import List, Optional, Dict, Tuple
 
 import torch
@@ -24,8 +26,7 @@ def _onnx_get_num_anchors_and_pre_nms_top_n(ob, orig_pre_nms_top_n):
 
 class AnchorsGenerator(nn.Module):
     __annotations__ = {
-        "cell_anchors": Optional[List[torch.Tensor]],
-        "_cache": Dict[str, List[torch.Tensor]]
+        "_cache": Dict[Tuple, torch.Tensor]
     }
 
     """
@@ -63,8 +64,16 @@ class AnchorsGenerator(nn.Module):
 
         self.sizes = sizes  # sizes=((32,), (64,), (128,), (256,), (512,))
         self.aspect_ratios = aspect_ratios  # aspect_ratios=((0.5, 1.0, 2.0),) * len(sizes)  list长度即为fpn输出特征图个数
-        self.cell_anchors = None  # set_cell_anchors()：[5, 3, 4] 5个特征图，每点对应3个anchors
-        self._cache = {}
+        # sizes和aspect_ratios在初始化后不再改变，直接在cpu上生成anchors模板，forward时只需搬运到对应设备
+        # 根据提供的sizes和aspect_ratios生成anchors模板，anchors模板都是以(0, 0)为中心的anchor
+        # 注册为buffer(cell_anchor_0, cell_anchor_1, ...)，使module.to(device)时anchors模板随模型一起移动
+        # [5, 3, 4] 5个特征图，每点对应3个anchors
+        for i, (scales, ratios) in enumerate(zip(self.sizes, self.aspect_ratios)):
+            cell_anchor = self.generate_anchors(scales, ratios, torch.float32, torch.device("cpu"))
+            self.register_buffer("cell_anchor_{}".format(i), cell_anchor, persistent=False)
+        # 缓存最近使用的_cache_size组特征图尺寸对应的anchors，超出时淘汰最久未使用的
+        self._cache = OrderedDict()
+        self._cache_size = 16
 
     def generate_anchors(self, scales, aspect_ratios, dtype=torch.float32, device=torch.device("cpu")):
         # type: (List[int], List[float], torch.dtype, torch.device) -> Tensor
@@ -83,7 +92,6 @@ class AnchorsGenerator(nn.Module):
         h_ratios = torch.sqrt(aspect_ratios)  # 开根保证anchors面积相同，tensor([0.7071, 1.0000, 1.4142])
         w_ratios = 1.0 / h_ratios  # tensor([1.4142, 1.0000, 0.7071])
 
-
         # [r1, r2, r3]' * [s1, s2, s3]
         # number of elements is len(ratios)*len(scales)
         ws = (w_ratios[:, None] * scales[None, :]).view(-1)  # tensor([45.2548, 32.0000, 22.6274])
@@ -95,32 +103,33 @@ class AnchorsGenerator(nn.Module):
 
         return base_anchors.round()  # round 四舍五入
 
+    def get_cell_anchors(self):
+        # type: () -> List[Tensor]
+        # 读取注册为buffer的anchors模板 [5, 3, 4]
+        return [getattr(self, "cell_anchor_{}".format(i)) for i in range(len(self.sizes))]
+
     def set_cell_anchors(self, dtype, device):
         # type: (torch.dtype, torch.device) -> None
-        if self.cell_anchors is not None:
-            cell_anchors = self.cell_anchors
-            assert cell_anchors is not None
-            # suppose that all anchors have the same device
-            # which is a valid assumption in the current state of the codebase
-            if cell_anchors[0].device == device:
-                return
-
-        # 根据提供的sizes和aspect_ratios生成anchors模板
-        # anchors模板都是以(0, 0)为中心的anchor
-        cell_anchors = [
-            self.generate_anchors(sizes, aspect_ratios, dtype, device)
-            for sizes, aspect_ratios in zip(self.sizes, self.aspect_ratios)
-        ]
-        self.cell_anchors = cell_anchors  # [5, 3, 4] 5个特征图，每点对应3个anchors
+        # anchors模板已在__init__中生成并随module.to(device)移动，这里只在设备或数据类型仍不一致时进行搬运
+        # suppose that all anchors have the same device
+        # which is a valid assumption in the current state of the codebase
+        cell_anchors = self.get_cell_anchors()
+        if cell_anchors[0].device != device or cell_anchors[0].dtype != dtype:
+            for i, cell_anchor in enumerate(cell_anchors):
+                setattr(self, "cell_anchor_{}".format(i), cell_anchor.to(dtype=dtype, device=device))
+
+        # 缓存的anchors不会随module.to(device)移动，设备改变后需要清空
+        if len(self._cache) > 0 and next(iter(self._cache.values())).device != device:
+            self._cache.clear()
 
     def num_anchors_per_location(self):
         # 计算每个预测特征层上每个滑动窗口的预测目标数k=3
         return [len(s) * len(a) for s, a in zip(self.sizes, self.aspect_ratios)]
 
-    # For every combination of (a, (g, s), i) in (self.cell_anchors, zip(grid_sizes, strides), 0:2),
+    # For every combination of (a, (g, s), i) in (self.get_cell_anchors(), zip(grid_sizes, strides), 0:2),
     # output g[i] anchors that are s[i] distance apart in direction i, with the same dimensions as a.
     def grid_anchors(self, grid_sizes, strides):
-        # type: (List[List[int]], List[List[Tensor]]) -> List[Tensor]
+        # type: (List[List[int]], List[List[int]]) -> List[Tensor]
         # grid_sizes: [5, 2]: [[feature_h, feature_w], ...]
         # strides: # [5, 2]: [[stride_h, stride_w], ...]
         """
@@ -132,8 +141,7 @@ class AnchorsGenerator(nn.Module):
             strides: 预测特征矩阵上一步对应原始图像上的步距
         """
         anchors = []
-        cell_anchors = self.cell_anchors  # [5, 3, 4] 5个特征图，每点对应3
-        assert cell_anchors is not None
+        cell_anchors = self.get_cell_anchors()  # [5, 3, 4] 5个特征图，每点对应3
 
         # 遍历每个预测特征层的grid_size，strides和cell_anchors
         for size, stride, base_anchors in zip(grid_sizes, strides, cell_anchors):
@@ -147,37 +155,38 @@ class AnchorsGenerator(nn.Module):
             # shape: [grid_height] 对应原图上的y坐标(行)
             shifts_y = torch.arange(0, grid_height, dtype=torch.float32, device=device) * stride_height
 
-            # 计算预测特征矩阵上每个点对应原图上的坐标(anchors模板的坐标偏移量)
-            # torch.meshgrid函数分别传入行坐标和列坐标，生成网格行坐标矩阵和网格列坐标矩阵
-            # shape: [grid_height, grid_width]
-            shift_y, shift_x = torch.meshgrid(shifts_y, shifts_x)
-            shift_x = shift_x.reshape(-1)
-            shift_y = shift_y.reshape(-1)
-
             # 计算anchors坐标(xmin, ymin, xmax, ymax)在原图上的坐标偏移量
-            # shape: [grid_width*grid_height, 4]
-            shifts = torch.stack([shift_x, shift_y, shift_x, shift_y], dim=1)
+            # 直接通过广播写入，不再经过meshgrid+stack生成中间结果
+            # shape: [grid_height, grid_width, 1, 4]
+            shifts = torch.empty((grid_height, grid_width, 1, 4), dtype=torch.float32, device=device)
+            shifts[..., 0::2] = shifts_x.view(1, -1, 1, 1)
+            shifts[..., 1::2] = shifts_y.view(-1, 1, 1, 1)
 
             # For every (base anchor, output anchor) pair,
             # offset each zero-centered base anchor by the center of the output anchor.
             # 将anchors模板与原图上的坐标偏移量相加得到原图上所有anchors的坐标信息(shape不同时会使用广播机制)
-            shifts_anchor = shifts.view(-1, 1, 4) + base_anchors.view(1, -1, 4)  # [grid_width*grid_height, 1, 4] + [1, 3, 4]
+            shifts_anchor = shifts + base_anchors.view(1, 1, -1, 4)  # [grid_height, grid_width, 1, 4] + [1, 1, 3, 4]
             anchors.append(shifts_anchor.reshape(-1, 4))
 
         # 每个特征图在padding图上生成了grid_width*grid_height*3的anchors
         return anchors  # List[Tensor(all_num_anchors, 4)] [5, all_num_anchors_i, 4]
 
     def cached_grid_anchors(self, grid_sizes, strides):
-        # type: (List[List[int]], List[List[Tensor]]) -> List[Tensor]
+        # type: (List[List[int]], List[List[int]]) -> Tensor
         # grid_sizes: [5, 2]: [[feature_h, feature_w], ...]
         # strides: # [5, 2]: [[stride_h, stride_w], ...]
-        """将计算得到的所有anchors信息进行缓存"""
-        key = str(grid_sizes) + str(strides)
-        # self._cache是字典类型
+        """将计算得到的所有anchors信息拼接后进行缓存(LRU)"""
+        key = (tuple((int(g[0]), int(g[1])) for g in grid_sizes),
+               tuple((s[0], s[1]) for s in strides))
+        # self._cache是OrderedDict类型，命中时移到末尾表示最近使用
         if key in self._cache:
+            self._cache.move_to_end(key)
             return self._cache[key]
-        anchors = self.grid_anchors(grid_sizes, strides)
+        # 将所有预测特征层的anchors坐标信息拼接在一起 [all_num_anchors_i, 4]*5 -> [5*ANA_i, 4]
+        anchors = torch.cat(self.grid_anchors(grid_sizes, strides), dim=0)
         self._cache[key] = anchors
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
         return anchors
 
     def forward(self, image_list, feature_maps):
@@ -194,32 +203,20 @@ class AnchorsGenerator(nn.Module):
 
         # one step in feature map equate n pixel stride in origin image
         # 计算特征层上的一步等于原始图像上的步长
-        strides = [[torch.tensor(image_size[0] // g[0], dtype=torch.int64, device=device),
-                    torch.tensor(image_size[1] // g[1], dtype=torch.int64, device=device)] for g in grid_sizes]
+        # 步长只作为标量参与乘法，直接使用python int，避免每次forward都创建设备上的标量tensor
+        strides = [[int(image_size[0] // g[0]), int(image_size[1] // g[1])] for g in grid_sizes]
 
         # 根据提供的sizes和aspect_ratios生成anchors模板
         self.set_cell_anchors(dtype, device)
 
         # 计算/读取所有anchors的坐标信息（这里的anchors信息是映射到原图上的所有anchors信息，不是anchors模板）
-        # 得到的是一个list列表，对应每张预测特征图映射回原图的anchors坐标信息
-        # [all_num_anchors_i, 4]*5
+        # 得到的是所有预测特征图映射回原图的anchors坐标信息拼接后的结果 [5*ANA_i, 4]
         anchors_over_all_feature_maps = self.cached_grid_anchors(grid_sizes, strides)
 
-        # 存储一个batchsize中所有图片的所有anchors
-        anchors = torch.jit.annotate(List[List[torch.Tensor]], [])
-        # 遍历一个batch中的每张图像，同一batch中图像尺寸都一样，因此anchors数都一样
-        for i, (image_height, image_width) in enumerate(image_list.image_sizes):
-            anchors_in_image = []
-            # 遍历每张预测特征图映射回原图的anchors坐标信息
-            for anchors_per_feature_map in anchors_over_all_feature_maps:
-                anchors_in_image.append(anchors_per_feature_map)
-            anchors.append(anchors_in_image)
-        # 将每一张图像的所有预测特征层的anchors坐标信息拼接在一起
+        # 同一batch中图像尺寸都一样(padding后)，因此每张图像的anchors完全相同，
+        # 这里所有图像共享同一个tensor，后续只读不写
         # anchors是个list，每个元素为一张图像的所有anchors信息
-        # [[all_num_anchors_i, 4]*5]*batch_size -> [5*ANA_i, 4]*batch_size List[torch.Tensor] List[Tensor(all_num_anchors, 4)]
-        anchors = [torch.cat(anchors_per_image) for anchors_per_image in anchors]
-        # Clear the cache in case that memory leaks.
-        self._cache.clear()
+        anchors = [anchors_over_all_feature_maps] * len(image_list.image_sizes)
         return anchors  # [5*ANA_i, 4]*batch_size
 
 
@@ -246,6 +243,8 @@ class RPNHead(nn.Module):
             if isinstance(layer, nn.Conv2d):
                 torch.nn.init.normal_(layer.weight, std=0.01)
                 torch.nn.init.constant_(layer.bias, 0)
+                # 权重使用channels_last(NHWC)格式，使cuDNN可以选择NHWC卷积实现(配合amp可使用Tensor Cores)
+                layer.to(memory_format=torch.channels_last)
 
     def forward(self, x):
         # type: (List[Tensor]) -> Tuple[List[Tensor], List[Tensor]]
@@ -253,38 +252,15 @@ class RPNHead(nn.Module):
         logits = []
         bbox_reg = []
         for i, feature in enumerate(x):  # FPN x:{OrderedDict:5}
-            t = F.relu(self.conv(feature))
+            # 输入同样转换为channels_last格式，与权重格式保持一致
+            feature = feature.contiguous(memory_format=torch.channels_last)
+            # self.conv的输出只在这里使用，可以直接inplace计算relu
+            t = F.relu(self.conv(feature), inplace=True)
             logits.append(self.cls_logits(t))
             bbox_reg.append(self.bbox_pred(t))
         return logits, bbox_reg
 
 
-def permute_and_flatten(layer, N, A, C, H, W):
-    # type: (Tensor, int, int, int, int, int) -> Tensor
-    """
-    调整tensor顺序，并进行reshape
-    Args:
-        layer: 预测特征层上预测的目标概率或bboxes regression参数
-        N: batch_size
-        A: anchors_num_per_position
-        C: classes_num or 4(bbox coordinate)
-        H: height
-        W: width
-
-    Returns:
-        layer: 调整tensor顺序，并reshape后的结果[N, -1, C]
-    """
-    # view和reshape功能是一样的，先展平所有元素在按照给定shape排列
-    # view函数只能用于内存中连续存储的tensor，permute等操作会使tensor在内存中变得不再连续，此时就不能再调用view函数
-    # reshape则不需要依赖目标tensor是否在内存中是连续的
-    # [batch_size, anchors_num_per_position * (C or 4), height, width]
-    layer = layer.view(N, -1, C,  H, W)
-    # 调换tensor维度
-    layer = layer.permute(0, 3, 4, 1, 2)  # [N, H, W, -1, C]
-    layer = layer.reshape(N, -1, C)
-    return layer
-
-
 def concat_box_prediction_layers(box_cls, box_regression):
     # type: (List[Tensor], List[Tensor]) -> Tuple[Tensor, Tensor]
     """
@@ -298,9 +274,19 @@ def concat_box_prediction_layers(box_cls, box_regression):
     Returns:
 
     """
-    box_cls_flattened = []
-    box_regression_flattened = []
-
+    # 所有预测特征层上的anchors总数，用于预先分配输出，避免先permute+reshape拷贝一次再torch.cat拷贝一次
+    N, AxC = box_cls[0].shape[:2]
+    A = box_regression[0].shape[1] // 4
+    C = AxC // A
+    total = 0
+    for box_cls_per_level in box_cls:
+        total += box_cls_per_level.shape[1] * box_cls_per_level.shape[2] * box_cls_per_level.shape[3] // C
+
+    # [batch_size, 5*-1, C], [batch_size, 5*-1, 4]
+    box_cls_out = box_cls[0].new_empty((N, total, C))
+    box_regression_out = box_regression[0].new_empty((N, total, 4))
+
+    offset = 0
     # 遍历每个预测特征层
     for box_cls_per_level, box_regression_per_level in zip(box_cls, box_regression):
         # [batch_size, anchors_num_per_position * classes_num, height, width]
@@ -312,18 +298,21 @@ def concat_box_prediction_layers(box_cls, box_regression):
         A = Ax4 // 4  # 3
         # classes_num
         C = AxC // A  # 1
+        n = A * H * W
 
-        # [batch_size, 3x1, H, W] -> [batch_size, -1, 1]  -1:anchors_num_per_feature
-        box_cls_per_level = permute_and_flatten(box_cls_per_level, N, A, C, H, W)
-        box_cls_flattened.append(box_cls_per_level)
+        # 调换tensor维度为[N, H, W, -1, C]，并直接将permute后的结果写入输出中对应的位置
+        # [batch_size, 3x1, H, W] -> [batch_size, H, W, 3, 1] -> box_cls_out[:, offset:offset + n, :]
+        box_cls_out[:, offset:offset + n].view(N, H, W, A, C).copy_(
+            box_cls_per_level.view(N, A, C, H, W).permute(0, 3, 4, 1, 2))
 
-        # [batch_size, 3x4, H, W] -> [batch_size, -1, 4]
-        box_regression_per_level = permute_and_flatten(box_regression_per_level, N, A, 4, H, W)
-        box_regression_flattened.append(box_regression_per_level)
+        # [batch_size, 3x4, H, W] -> [batch_size, H, W, 3, 4] -> box_regression_out[:, offset:offset + n, :]
+        box_regression_out[:, offset:offset + n].view(N, H, W, A, 4).copy_(
+            box_regression_per_level.view(N, A, 4, H, W).permute(0, 3, 4, 1, 2))
+        offset += n
 
-    # [batch_size, -1, 1]*5 -> [batch_size, 5*-1, 1] -> [batch_size*5*-1, 1]
-    box_cls = torch.cat(box_cls_flattened, dim=1).flatten(0, -2)  # start_dim, end_dim
-    box_regression = torch.cat(box_regression_flattened, dim=1).reshape(-1, 4)
+    # [batch_size, 5*-1, 1] -> [batch_size*5*-1, 1]
+    box_cls = box_cls_out.flatten(0, -2)  # start_dim, end_dim
+    box_regression = box_regression_out.reshape(-1, 4)
     return box_cls, box_regression
 
 
@@ -400,6 +389,15 @@ class RegionProposalNetwork(torch.nn.Module):
             return self._post_nms_top_n['training']
         return self._post_nms_top_n['testing']
 
+    def _score_thresh_logit(self):
+        # type: () -> float
+        # 将概率阈值score_thresh转换为对应的logits阈值: sigmoid(x) >= t <=> x >= log(t / (1 - t))
+        if self.score_thresh <= 0.:
+            return -math.inf
+        if self.score_thresh >= 1.:
+            return math.inf
+        return math.log(self.score_thresh / (1. - self.score_thresh))
+
     def assign_targets_to_anchors(self, anchors, targets):
         # type: (List[Tensor], List[Dict[str, Tensor]]) -> Tuple[List[Tensor], List[Tensor]]
         """
@@ -418,9 +416,12 @@ class RegionProposalNetwork(torch.nn.Module):
         for anchors_per_image, targets_per_image in zip(anchors, targets):
             gt_boxes = targets_per_image["boxes"]
             if gt_boxes.numel() == 0:
+                # 没有gt时所有anchors都是背景，通过expand得到全0的tensor，不需要真正分配并清零内存
+                # 后续只会读取(torch.cat等)，不会对其进行inplace修改
                 device = anchors_per_image.device
-                matched_gt_boxes_per_image = torch.zeros(anchors_per_image.shape, dtype=torch.float32, device=device)
-                labels_per_image = torch.zeros((anchors_per_image.shape[0],), dtype=torch.float32, device=device)
+                zero = torch.zeros((), dtype=torch.float32, device=device)
+                matched_gt_boxes_per_image = zero.expand_as(anchors_per_image)
+                labels_per_image = zero.expand(anchors_per_image.shape[0])
             else:
                 # 计算anchors与真实bbox的iou信息
                 # set to self.box_similarity when https://github.com/pytorch/pytorch/issues/27495 lands
@@ -436,16 +437,12 @@ class RegionProposalNetwork(torch.nn.Module):
                 # 计算边界框回归损失时只使用索引>=0的正样本
                 matched_gt_boxes_per_image = gt_boxes[matched_idxs.clamp(min=0)]
 
-                labels_per_image = matched_idxs >= 0
-                labels_per_image = labels_per_image.to(dtype=torch.float32)  # 1.0
-
-                # background (negative examples)
-                bg_indices = matched_idxs == self.proposal_matcher.BELOW_LOW_THRESHOLD  # -1
-                labels_per_image[bg_indices] = 0.0
-
-                # discard indices that are between thresholds
-                inds_to_discard = matched_idxs == self.proposal_matcher.BETWEEN_THRESHOLDS  # -2
-                labels_per_image[inds_to_discard] = -1.0
+                # 一次计算得到所有anchors的标签，不再分别生成mask后索引写入
+                # 正样本(matched_idxs >= 0): 1.0 - 0.0 = 1.0
+                # background (negative examples) BELOW_LOW_THRESHOLD(-1): 0.0 - 0.0 = 0.0
+                # discard indices that are between thresholds BETWEEN_THRESHOLDS(-2): 0.0 - 1.0 = -1.0
+                labels_per_image = torch.ge(matched_idxs, 0).to(dtype=torch.float32) - \
+                    torch.eq(matched_idxs, self.proposal_matcher.BETWEEN_THRESHOLDS).to(dtype=torch.float32)
 
             labels.append(labels_per_image)
             matched_gt_boxes.append(matched_gt_boxes_per_image)
@@ -461,22 +458,34 @@ class RegionProposalNetwork(torch.nn.Module):
         Returns:
 
         """
-        r = []  # 记录每个预测特征层上预测目标概率前pre_nms_top_n的索引信息
-        offset = 0
+        if torchvision._is_tracing():
+            r = []  # 记录每个预测特征层上预测目标概率前pre_nms_top_n的索引信息
+            offset = 0
+            # 遍历每个预测特征层上的预测目标概率信息
+            for ob in objectness.split(num_anchors_per_level, 1):
+                # ob: [batch_size, 3*H_i*W_i]
+                num_anchors, pre_nms_top_n = _onnx_get_num_anchors_and_pre_nms_top_n(ob, self.pre_nms_top_n())
+                _, top_n_idx = ob.topk(pre_nms_top_n, dim=1, sorted=False)
+                r.append(top_n_idx + offset)
+                offset += num_anchors
+            return torch.cat(r, dim=1)  # [batch_size, <=2000 * 5]
+
+        # 每个预测特征层上保留的proposals个数，预先分配好输出，直接写入对应位置，不再需要torch.cat
+        top_n_per_level = [min(self.pre_nms_top_n(), n) for n in num_anchors_per_level]
+        r = torch.empty((objectness.shape[0], sum(top_n_per_level)),
+                        dtype=torch.int64, device=objectness.device)  # [batch_size, <=2000 * 5]
+        offset = 0  # 当前预测特征层在所有anchors中的起始索引
+        start = 0  # 当前预测特征层在输出中的起始位置
         # 遍历每个预测特征层上的预测目标概率信息
-        for ob in objectness.split(num_anchors_per_level, 1):
+        for ob, pre_nms_top_n in zip(objectness.split(num_anchors_per_level, 1), top_n_per_level):
             # ob: [batch_size, 3*H_i*W_i]
-            if torchvision._is_tracing():
-                num_anchors, pre_nms_top_n = _onnx_get_num_anchors_and_pre_nms_top_n(ob, self.pre_nms_top_n())
-            else:
-                num_anchors = ob.shape[1]  # 预测特征层上的预测的proposals个数
-                pre_nms_top_n = min(self.pre_nms_top_n(), num_anchors)
-
             # Returns the k largest elements of the given input tensor along a given dimension
-            _, top_n_idx = ob.topk(pre_nms_top_n, dim=1)  # 每张图都不一样
-            r.append(top_n_idx + offset)
-            offset += num_anchors
-        return torch.cat(r, dim=1)  # [batch_size, <=2000 * 5]
+            # 后面的nms会按score重新排序，这里不需要对topk的结果排序
+            _, top_n_idx = ob.topk(pre_nms_top_n, dim=1, sorted=False)  # 每张图都不一样
+            r[:, start:start + pre_nms_top_n].copy_(top_n_idx).add_(offset)
+            offset += ob.shape[1]
+            start += pre_nms_top_n
+        return r  # [batch_size, <=2000 * 5]
 
     def filter_proposals(self, proposals, objectness, image_shapes, num_anchors_per_level):
         # type: (Tensor, Tensor, List[Tuple[int, int]], List[int]) -> Tuple[List[Tensor], List[Tensor]]
@@ -497,8 +506,8 @@ class RegionProposalNetwork(torch.nn.Module):
         device = proposals.device
 
         # do not backprop throught objectness
-        objectness = objectness.detach()
-        objectness = objectness.reshape(num_images, -1)  # [batch_size, -1]
+        # concat_box_prediction_layers输出的objectness是连续的，可以直接view
+        objectness = objectness.detach().view(num_images, -1)  # [batch_size, -1]
 
         # Returns a tensor of size size filled with fill_value
         # levels负责记录分隔不同预测特征层上的proposals索引信息
@@ -526,37 +535,43 @@ class RegionProposalNetwork(torch.nn.Module):
         # 预测概率排前pre_nms_top_n的proposals索引值获取相应bbox坐标信息
         proposals = proposals[batch_idx, top_n_idx]  # [batch_size, -1, 4]
 
-        objectness_prob = torch.sigmoid(objectness)
+        # 调整预测的boxes信息，将越界的坐标调整到对应图片边界上
+        if torchvision._is_tracing():
+            # tracing时逐张图像调用clip_boxes_to_image，避免将image_shapes作为常量tensor记录到graph中
+            proposals = torch.stack([box_ops.clip_boxes_to_image(boxes, img_shape)
+                                     for boxes, img_shape in zip(proposals, image_shapes)])
+        else:
+            # 通过广播一次处理整个batch
+            # image_shapes: [(h, w), ...] -> [batch_size, 1, 4]: [[[w, h, w, h]], ...]
+            shapes = torch.as_tensor(image_shapes, dtype=proposals.dtype, device=device)[:, [1, 0, 1, 0]]
+            proposals = torch.min(proposals.clamp(min=0), shapes[:, None, :])  # [batch_size, -1, 4]
+
+        # 同时移除宽，高小于min_size的boxes以及小概率boxes，合并为一个mask [batch_size, -1]
+        # self.score_thresh默认为0.0，经过sigmoid后，scores都满足，参考下面这个链接
+        # https://github.com/pytorch/vision/pull/3205
+        # predict 时设置为0.5将滤除掉大量背景， train时设置为0保留背景，以便roi_head有负样本进行训练
+        # 这里的objectness仍是logits，sigmoid是单调的，阈值筛选和nms排序都可以直接在logits上进行，
+        # 只对最终保留下来的proposals计算sigmoid
+        wh = proposals[..., 2:] - proposals[..., :2]  # 预测boxes的宽和高 [batch_size, -1, 2]
+        keep = torch.ge(wh, self.min_size).all(dim=-1) & torch.ge(objectness, self._score_thresh_logit())
 
         final_boxes = []
         final_scores = []
-        # 遍历每张图像的相关预测信息
-        for boxes, scores, lvl, img_shape in zip(proposals, objectness_prob, levels, image_shapes):
-            # 调整预测的boxes信息，将越界的坐标调整到图片边界上
-            boxes = box_ops.clip_boxes_to_image(boxes, img_shape)
-
-            # 返回boxes满足宽，高都大于min_size的索引
-            keep = box_ops.remove_small_boxes(boxes, self.min_size)
-            boxes, scores, lvl = boxes[keep], scores[keep], lvl[keep]
-
-            # 移除小概率boxes，参考下面这个链接
-            # self.score_thresh默认为0.0，经过sigmoid后，scores都满足
-            # https://github.com/pytorch/vision/pull/3205
-            # predict 时设置为0.5将滤除掉大量背景， train时设置为0保留背景，以便roi_head有负样本进行训练
-            keep = torch.where(torch.ge(scores, self.score_thresh))[0]  # ge: >=
-            boxes, scores, lvl = boxes[keep], scores[keep], lvl[keep]
+        # 裁剪与筛选已对整个batch完成，nms仍逐张图像进行：
+        # 对展平后的整个batch做一次nms会在所有图像的proposals之间两两计算iou，计算量随batch_size平方增长
+        for boxes, scores, lvl, keep_per_image in zip(proposals, objectness, levels, keep):
+            keep_per_image = torch.where(keep_per_image)[0]
+            boxes, scores, lvl = boxes[keep_per_image], scores[keep_per_image], lvl[keep_per_image]
 
             # non-maximum suppression, independently done per level
             # self.nms_thresh = 0.7
-            keep = box_ops.batched_nms(boxes, scores, lvl, self.nms_thresh)
+            keep_per_image = box_ops.batched_nms(boxes, scores, lvl, self.nms_thresh)
 
             # keep only topk scoring predictions
             # 前面是每个特征图最多保留self.pre_nms_top_n()个目标，这里是总共保留目标数
-            keep = keep[: self.post_nms_top_n()]
-            boxes, scores = boxes[keep], scores[keep]
-
-            final_boxes.append(boxes)
-            final_scores.append(scores)
+            keep_per_image = keep_per_image[: self.post_nms_top_n()]
+            final_boxes.append(boxes[keep_per_image])
+            final_scores.append(torch.sigmoid(scores[keep_per_image]))
         return final_boxes, final_scores
 
     def compute_loss(self, objectness, pred_bbox_deltas, labels, regression_targets):
@@ -574,12 +589,19 @@ class RegionProposalNetwork(torch.nn.Module):
             box_loss (Tensor)：边界框回归损失
         """
         # 按照给定的batch_size_per_image, positive_fraction选择正负样本
-        sampled_pos_inds, sampled_neg_inds = self.fg_bg_sampler(labels)
-        # 将一个batch中的所有正负样本List(Tensor)分别拼接在一起，并获取非零位置的索引
-        # sampled_pos_inds = torch.nonzero(torch.cat(sampled_pos_inds, dim=0)).squeeze(1)
-        sampled_pos_inds = torch.where(torch.cat(sampled_pos_inds, dim=0))[0]
-        # sampled_neg_inds = torch.nonzero(torch.cat(sampled_neg_inds, dim=0)).squeeze(1)
-        sampled_neg_inds = torch.where(torch.cat(sampled_neg_inds, dim=0))[0]
+        # 直接获取每张图像采样得到的正负样本索引，不再生成整个batch所有anchors大小的mask
+        sampled_pos_inds, sampled_neg_inds = self.fg_bg_sampler.sample_indices(labels)
+        # 加上每张图像anchors在整个batch中的偏移量后，将一个batch中的所有正负样本索引分别拼接在一起
+        pos_inds = []
+        neg_inds = []
+        offset = 0
+        for pos_inds_per_image, neg_inds_per_image, labels_per_image in zip(
+                sampled_pos_inds, sampled_neg_inds, labels):
+            pos_inds.append(pos_inds_per_image + offset)
+            neg_inds.append(neg_inds_per_image + offset)
+            offset += labels_per_image.shape[0]
+        sampled_pos_inds = torch.cat(pos_inds, dim=0)
+        sampled_neg_inds = torch.cat(neg_inds, dim=0)
 
         # 将所有正负样本索引拼接在一起
         sampled_inds = torch.cat([sampled_pos_inds, sampled_neg_inds], dim=0)  # [<=256*batch_size,1]
@@ -661,8 +683,14 @@ class RegionProposalNetwork(torch.nn.Module):
         # note that we detach the deltas because Faster R-CNN do not backprop through
         # the proposals 就是后面更新ROIHead参数时RPN和Backbone是冻结的？
         # 将预测的bbox regression参数应用到anchors上得到最终预测bbox坐标
-        proposals = self.box_coder.decode(pred_bbox_deltas.detach(), anchors)
-        proposals = proposals.view(num_images, -1, 4)  # [batch_size, num_anchors, 4]
+        # 按[batch_size, num_anchors, 4]的形状进行解码，直接得到对应形状的结果，不需要再view
+        pred_bbox_deltas_nd = pred_bbox_deltas.detach().view(num_images, -1, 4)
+        if all(a is anchors[0] for a in anchors):
+            # AnchorsGenerator返回的每张图像的anchors是同一个tensor，直接利用广播机制，不需要复制batch_size份
+            anchors_nd = anchors[0].unsqueeze(0)  # [1, num_anchors, 4]
+        else:
+            anchors_nd = torch.stack(anchors)  # [batch_size, num_anchors, 4]
+        proposals = self.box_coder.decode_single(pred_bbox_deltas_nd, anchors_nd)  # [batch_size, num_anchors, 4]
 
         # 筛除小boxes框，nms处理，根据预测概率获取前post_nms_top_n个目标
         boxes, scores = self.filter_proposals(proposals, objectness, images.image_sizes, num_anchors_per_level)